@@ -19,63 +19,146 @@ import mujoco
 import numpy as np
 import warp as wp
 from absl.testing import absltest
+from absl.testing import parameterized
 
 import mujoco_warp as mjwarp
 
 from . import collision_driver
 
-
-def _load_from_string(xml: str, keyframe: int = -1):
-  mjm = mujoco.MjModel.from_xml_string(xml)
+_SAP_MODEL = """
+  <mujoco>
+    <worldbody>
+      <geom size="40 40 40" type="plane"/>   <!- (0) intersects with nothing -->
+      <body pos="0 0 0.7">
+        <freejoint/>
+        <geom size="0.5 0.5 0.5" type="box"/> <!- (1) intersects with 2, 6, 7 -->
+      </body>
+      <body pos="0.1 0 0.7">
+        <freejoint/>
+        <geom size="0.5 0.5 0.5" type="box"/> <!- (2) intersects with 1, 6, 7 -->
+      </body>
+      <body pos="1.8 0 0.7">
+        <freejoint/>
+        <geom size="0.5 0.5 0.5" type="box"/> <!- (3) intersects with 4  -->
+      </body>
+      <body pos="1.6 0 0.7">
+        <freejoint/>
+        <geom size="0.5 0.5 0.5" type="box"/> <!- (4) intersects with 3 -->
+      </body>
+      <body pos="0 0 1.8">
+        <freejoint/>
+        <geom size="0.5 0.5 0.5" type="box"/> <!- (5) intersects with 7 -->
+        <geom size="0.5 0.5 0.5" type="box" pos="0 0 -1"/> <!- (6) intersects with 2, 1, 7 -->
+      </body>
+      <body pos="0 0.5 1.2">
+        <freejoint/>
+        <geom size="0.5 0.5 0.5" type="box"/> <!- (7) intersects with 5, 6 -->
+      </body>
+    </worldbody>
+  </mujoco>
+"""
+
+
+_NXN_MODEL = """
+  <mujoco>
+    <worldbody>
+      <body>
+        <freejoint/>
+        <geom type="sphere" size="0.1"/>
+      </body>
+      <body>
+        <freejoint/>
+        <geom type="sphere" size="0.1"/>
+      </body>
+      <body>
+        <freejoint/>
+        <geom type="capsule" size="0.1 0.1"/>
+      </body>
+      <body>
+        <freejoint/>
+        <geom type="sphere" size="0.1"/>
+      </body>
+      <body>
+        <freejoint/>
+        <!-- self collision -->
+        <geom type="sphere" size="0.1"/>
+        <geom type="sphere" size="0.1"/>
+        <!-- parent-child self collision -->
+        <body>
+          <geom type="sphere" size="0.1"/>
+          <joint type="hinge"/>
+        </body>
+      </body>
+    </worldbody>
+    <keyframe>
+      <key qpos='0 0 0 1 0 0 0
+                1 0 0 1 0 0 0
+                2 0 0 1 0 0 0
+                3 0 0 1 0 0 0
+                4 0 0 1 0 0 0
+                0'/>
+      <key qpos='0 0 0 1 0 0 0
+                .05 0 0 1 0 0 0
+                2 0 0 1 0 0 0
+                3 0 0 1 0 0 0
+                4 0 0 1 0 0 0 
+                0'/>
+      <key qpos='0 0 0 1 0 0 0
+                .01 0 0 1 0 0 0
+                .02 0 0 1 0 0 0
+                3 0 0 1 0 0 0
+                4 0 0 1 0 0 0 
+                0'/>
+      <key qpos='0 0 0 1 0 0 0
+                1 0 0 1 0 0 0
+                2 0 0 1 0 0 0
+                2 0 0 1 0 0 0
+                4 0 0 1 0 0 0 
+                0'/>
+    </keyframe>
+  </mujoco>
+"""
+
+
+def _collision_pairs(d: mjwarp.Data):
+  """Returns the broadphase geom pairs as a set of sorted tuples."""
+  ncollision = d.ncollision.numpy()[0]
+  pairs = np.sort(d.collision_pair.numpy()[:ncollision], axis=1)
+  return set(map(tuple, pairs.tolist()))
+
+
+def _load_nxn_geom_xpos_table(mjm: mujoco.MjModel):
+  """Returns geom positions for each keyframe of the nxn model."""
   mjd = mujoco.MjData(mjm)
-  if keyframe > -1:
+  table = {}
+  for keyframe in range(mjm.nkey):
     mujoco.mj_resetDataKeyframe(mjm, mjd, keyframe)
-  mujoco.mj_forward(mjm, mjd)
-
-  m = mjwarp.put_model(mjm)
-  d = mjwarp.put_data(mjm, mjd)
-
-  return mjm, mjd, m, d
+    mujoco.mj_kinematics(mjm, mjd)
+    table[keyframe] = mjd.geom_xpos.copy()
+  return table
+
+
+class BroadphaseTest(parameterized.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    super().setUpClass()
+    cls.sap_mjm = mujoco.MjModel.from_xml_string(_SAP_MODEL)
+    cls.sap_mjd = mujoco.MjData(cls.sap_mjm)
+    mujoco.mj_forward(cls.sap_mjm, cls.sap_mjd)
+    cls.sap_m = mjwarp.put_model(cls.sap_mjm)
+    cls.nxn_mjm = mujoco.MjModel.from_xml_string(_NXN_MODEL)
+    cls.nxn_m = mjwarp.put_model(cls.nxn_mjm)
+    cls.nxn_geom_xpos = _load_nxn_geom_xpos_table(cls.nxn_mjm)
+
+  def _nxn_data(self, keyframe: int):
+    d = mjwarp.make_data(self.nxn_mjm)
+    d.geom_xpos.assign(self.nxn_geom_xpos[keyframe][None])
+    return d
 
-
-class BroadphaseTest(absltest.TestCase):
   def test_sap_broadphase(self):
     """Tests sap_broadphase."""
 
-    _SAP_MODEL = """
-      <mujoco>
-        <worldbody>
-          <geom size="40 40 40" type="plane"/>   <!- (0) intersects with nothing -->
-          <body pos="0 0 0.7">
-            <freejoint/>
-            <geom size="0.5 0.5 0.5" type="box"/> <!- (1) intersects with 2, 6, 7 -->
-          </body>
-          <body pos="0.1 0 0.7">
-            <freejoint/>
-            <geom size="0.5 0.5 0.5" type="box"/> <!- (2) intersects with 1, 6, 7 -->
-          </body>
-          <body pos="1.8 0 0.7">
-            <freejoint/>
-            <geom size="0.5 0.5 0.5" type="box"/> <!- (3) intersects with 4  -->
-          </body>
-          <body pos="1.6 0 0.7">
-            <freejoint/>
-            <geom size="0.5 0.5 0.5" type="box"/> <!- (4) intersects with 3 -->
-          </body>
-          <body pos="0 0 1.8">
-            <freejoint/>
-            <geom size="0.5 0.5 0.5" type="box"/> <!- (5) intersects with 7 -->
-            <geom size="0.5 0.5 0.5" type="box" pos="0 0 -1"/> <!- (6) intersects with 2, 1, 7 -->
-          </body>
-          <body pos="0 0.5 1.2">
-            <freejoint/>
-            <geom size="0.5 0.5 0.5" type="box"/> <!- (7) intersects with 5, 6 -->
-          </body>
-        </worldbody>
-      </mujoco>
-    """
-
-    collision_pair = [
+    collision_pair = {
       (0, 1),
       (0, 2),
       (0, 3),
@@ -95,151 +178,68 @@ class BroadphaseTest(absltest.TestCase):
       (4, 6),
       (5, 7),
       (6, 7),
-    ]
-
-    _, _, m, d = _load_from_string(_SAP_MODEL)
+    }
 
-    mjwarp.sap_broadphase(m, d)
+    d = mjwarp.put_data(self.sap_mjm, self.sap_mjd)
+    mjwarp.sap_broadphase(self.sap_m, d)
 
     ncollision = d.ncollision.numpy()[0]
     np.testing.assert_equal(ncollision, len(collision_pair), "ncollision")
 
-    for i in range(ncollision):
-      pair = d.collision_pair.numpy()[i]
-      if pair[0] > pair[1]:
-        pair_tuple = (int(pair[1]), int(pair[0]))
-      else:
-        pair_tuple = (int(pair[0]), int(pair[1]))
-
-      np.testing.assert_equal(
-        pair_tuple in collision_pair,
-        True,
-        f"geom pair {pair_tuple} not found in brute force results",
-      )
+    self.assertSetEqual(_collision_pairs(d), collision_pair)
 
-    # TODO(team): test DisableBit.FILTERPARENT
+    # nxn_broadphase is a brute-force search on the same device
+    d_nxn = mjwarp.put_data(self.sap_mjm, self.sap_mjd)
+    mjwarp.nxn_broadphase(self.sap_m, d_nxn)
+    self.assertSetEqual(_collision_pairs(d), _collision_pairs(d_nxn))
 
     # TODO(team): test DisableBit.FILTERPARENT
 
-  def test_nxn_broadphase(self):
+  @parameterized.parameters(
+    (0, []),  # one world and zero collisions
+    (1, [(0, 1)]),  # one world and one collision
+    (2, [(0, 1), (0, 2), (1, 2)]),  # one world and three collisions
+    (3, [(3, 2)]),  # one world and one collision: geomtype ordering
+  )
+  def test_nxn_broadphase(self, keyframe, collision_pair):
     """Tests nxn_broadphase."""
+    d = self._nxn_data(keyframe)
+    collision_driver.nxn_broadphase(self.nxn_m, d)
 
-    _NXN_MODEL = """
-      <mujoco>
-        <worldbody>
-          <body>
-            <freejoint/>
-            <geom type="sphere" size="0.1"/>
-          </body>
-          <body>
-            <freejoint/>
-            <geom type="sphere" size="0.1"/>
-          </body>
-          <body>
-            <freejoint/>
-            <geom type="capsule" size="0.1 0.1"/>
-          </body>
-          <body>
-            <freejoint/>
-            <geom type="sphere" size="0.1"/>
-          </body>
-          <body>
-            <freejoint/>
-            <!-- self collision -->
-            <geom type="sphere" size="0.1"/>
-            <geom type="sphere" size="0.1"/>
-            <!-- parent-child self collision -->
-            <body>
-              <geom type="sphere" size="0.1"/>
-              <joint type="hinge"/>
-            </body>
-          </body>
-        </worldbody>
-        <keyframe>
-          <key qpos='0 0 0 1 0 0 0
-                    1 0 0 1 0 0 0
-                    2 0 0 1 0 0 0
-                    3 0 0 1 0 0 0
-                    4 0 0 1 0 0 0
-                    0'/>
-          <key qpos='0 0 0 1 0 0 0
-                    .05 0 0 1 0 0 0
-                    2 0 0 1 0 0 0
-                    3 0 0 1 0 0 0
-                    4 0 0 1 0 0 0 
-                    0'/>
-          <key qpos='0 0 0 1 0 0 0
-                    .01 0 0 1 0 0 0
-                    .02 0 0 1 0 0 0
-                    3 0 0 1 0 0 0
-                    4 0 0 1 0 0 0 
-                    0'/>
-          <key qpos='0 0 0 1 0 0 0
-                    1 0 0 1 0 0 0
-                    2 0 0 1 0 0 0
-                    2 0 0 1 0 0 0
-                    4 0 0 1 0 0 0 
-                    0'/>
-        </keyframe>
-      </mujoco>
-    """
-    # one world and zero collisions
-    mjm, _, m, d0 = _load_from_string(_NXN_MODEL, keyframe=0)
-    collision_driver.nxn_broadphase(m, d0)
-    np.testing.assert_allclose(d0.ncollision.numpy()[0], 0)
-
-    # one world and one collision
-    _, mjd1, _, d1 = _load_from_string(_NXN_MODEL, keyframe=1)
-    collision_driver.nxn_broadphase(m, d1)
-
-    np.testing.assert_allclose(d1.ncollision.numpy()[0], 1)
-    np.testing.assert_allclose(d1.collision_pair.numpy()[0][0], 0)
-    np.testing.assert_allclose(d1.collision_pair.numpy()[0][1], 1)
-
-    # one world and three collisions
-    _, mjd2, _, d2 = _load_from_string(_NXN_MODEL, keyframe=2)
-    collision_driver.nxn_broadphase(m, d2)
-    np.testing.assert_allclose(d2.ncollision.numpy()[0], 3)
-    np.testing.assert_allclose(d2.collision_pair.numpy()[0][0], 0)
-    np.testing.assert_allclose(d2.collision_pair.numpy()[0][1], 1)
-    np.testing.assert_allclose(d2.collision_pair.numpy()[1][0], 0)
-    np.testing.assert_allclose(d2.collision_pair.numpy()[1][1], 2)
-    np.testing.assert_allclose(d2.collision_pair.numpy()[2][0], 1)
-    np.testing.assert_allclose(d2.collision_pair.numpy()[2][1], 2)
+    ncollision = d.ncollision.numpy()[0]
+    np.testing.assert_equal(ncollision, len(collision_pair), "ncollision")
+    pairs = d.collision_pair.numpy()
+    for i in range(ncollision):
+      np.testing.assert_equal(pairs[i], collision_pair[i])
 
+  def test_nxn_broadphase_multiworld(self):
+    """Tests nxn_broadphase with two worlds."""
     # two worlds and four collisions
-    d3 = mjwarp.make_data(mjm, nworld=2)
-    d3.geom_xpos = wp.array(
-      np.vstack(
-        [np.expand_dims(mjd1.geom_xpos, axis=0), np.expand_dims(mjd2.geom_xpos, axis=0)]
-      ),
-      dtype=wp.vec3,
-    )
-
-    collision_driver.nxn_broadphase(m, d3)
-    np.testing.assert_allclose(d3.ncollision.numpy()[0], 4)
-    np.testing.assert_allclose(d3.collision_pair.numpy()[0][0], 0)
-    np.testing.assert_allclose(d3.collision_pair.numpy()[0][1], 1)
-    np.testing.assert_allclose(d3.collision_pair.numpy()[1][0], 0)
-    np.testing.assert_allclose(d3.collision_pair.numpy()[1][1], 1)
-    np.testing.assert_allclose(d3.collision_pair.numpy()[2][0], 0)
-    np.testing.assert_allclose(d3.collision_pair.numpy()[2][1], 2)
-    np.testing.assert_allclose(d3.collision_pair.numpy()[3][0], 1)
-    np.testing.assert_allclose(d3.collision_pair.numpy()[3][1], 2)
+    d = mjwarp.make_data(self.nxn_mjm, nworld=2)
+    d.geom_xpos.assign(np.stack([self.nxn_geom_xpos[1], self.nxn_geom_xpos[2]]))
+
+    collision_driver.nxn_broadphase(self.nxn_m, d)
+    pairs = d.collision_pair.numpy()
+    np.testing.assert_allclose(d.ncollision.numpy()[0], 4)
+    np.testing.assert_allclose(pairs[0][0], 0)
+    np.testing.assert_allclose(pairs[0][1], 1)
+    np.testing.assert_allclose(pairs[1][0], 0)
+    np.testing.assert_allclose(pairs[1][1], 1)
+    np.testing.assert_allclose(pairs[2][0], 0)
+    np.testing.assert_allclose(pairs[2][1], 2)
+    np.testing.assert_allclose(pairs[3][0], 1)
+    np.testing.assert_allclose(pairs[3][1], 2)
+
+  def test_nxn_broadphase_contype(self):
+    """Tests nxn_broadphase contype and conaffinity filtering."""
+    d = self._nxn_data(1)
 
     # one world and zero collisions: contype and conaffinity incompatibility
-    _, _, m4, d4 = _load_from_string(_NXN_MODEL, keyframe=1)
-    m4.geom_contype = wp.array(np.array([0, 0, 0]), dtype=wp.int32)
-    m4.geom_conaffinity = wp.array(np.array([1, 1, 1]), dtype=wp.int32)
-    collision_driver.nxn_broadphase(m4, d4)
-    np.testing.assert_allclose(d4.ncollision.numpy()[0], 0)
-
-    # one world and one collision: geomtype ordering
-    _, _, _, d5 = _load_from_string(_NXN_MODEL, keyframe=3)
-    collision_driver.nxn_broadphase(m, d5)
-    np.testing.assert_allclose(d5.ncollision.numpy()[0], 1)
-    np.testing.assert_allclose(d5.collision_pair.numpy()[0][0], 3)
-    np.testing.assert_allclose(d5.collision_pair.numpy()[0][1], 2)
+    m = mjwarp.put_model(self.nxn_mjm)
+    m.geom_contype = wp.array(np.array([0, 0, 0]), dtype=wp.int32)
+    m.geom_conaffinity = wp.array(np.array([1, 1, 1]), dtype=wp.int32)
+    collision_driver.nxn_broadphase(m, d)
+    np.testing.assert_allclose(d.ncollision.numpy()[0], 0)
 
     # TODO(team): test margin
     # TODO(team): test DisableBit.FILTERPARENT